@@ -4,5 +4,6 @@ import os
 class Settings(BaseModel):
     valhalla_url: str = os.getenv("VALHALLA_URL", "http://localhost:8002")
     gtfs_dir: str = os.getenv("GTFS_DIR", "/data/gtfs")
+    prepared_cache_dir: str = os.getenv("PREPARED_CACHE_DIR", "/data/prepared_cache")
 
 settings = Settings()
@@ -1,44 +1,68 @@
 import math
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional
 
-def haversine_m(a: Tuple[float, float], b: Tuple[float, float]) -> float:
-    # a,b = (lat, lon)
-    R = 6371000.0
-    lat1, lon1 = math.radians(a[0]), math.radians(a[1])
-    lat2, lon2 = math.radians(b[0]), math.radians(b[1])
+import numpy as np
+from numba import njit
+
+def _haversine_h(lats1, lons1, lats2, lons2) -> np.ndarray:
+    """
+    Haversine term h = sin^2(dlat/2) + cos(lat1)*cos(lat2)*sin^2(dlon/2), element-wise over degrees.
+    Central angle is 2*asin(sqrt(h)).
+    """
+    lat1 = np.radians(np.asarray(lats1, dtype=np.float64))
+    lon1 = np.radians(np.asarray(lons1, dtype=np.float64))
+    lat2 = np.radians(np.asarray(lats2, dtype=np.float64))
+    lon2 = np.radians(np.asarray(lons2, dtype=np.float64))
     dlat = lat2 - lat1
     dlon = lon2 - lon1
-    h = (math.sin(dlat / 2) ** 2 +
-         math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2)
-    return 2 * R * math.asin(math.sqrt(h))
+    return (np.sin(dlat / 2) ** 2 +
+            np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2)
 
-def downsample_by_distance(points: List[Tuple[float, float]], min_step_m: float = 15.0) -> List[Tuple[float, float]]:
+def haversine_vec(lats1, lons1, lats2, lons2) -> np.ndarray:
     """
-    Keep first point, then keep a point only if it's at least min_step_m away from last kept.
-    Always keep last point.
+    Great-circle distance in meters, element-wise over arrays of degrees.
     """
-    if not points:
-        return []
-    if len(points) == 1:
-        return points[:]
-    kept = [points[0]]
-    last = points[0]
-    for p in points[1:-1]:
-        if haversine_m(last, p) >= min_step_m:
-            kept.append(p)
-            last = p
-    kept.append(points[-1])
-    return kept
+    R = 6371000.0
+    h = _haversine_h(lats1, lons1, lats2, lons2)
+    return 2 * R * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+# Below this chord 2R*sqrt(h) matches 2R*asin(sqrt(h)) to ~1e-9 relative
+SMALL_ANGLE_MAX_M = 1000.0
 
-def _to_xy_m(lat0: float, lon0: float, lat: float, lon: float) -> Tuple[float, float]:
+def haversine_small_angle(lats1, lons1, lats2, lons2) -> np.ndarray:
     """
-    Equirectangular approximation: convert lat/lon to local meters around (lat0, lon0).
-    Accurate enough for snapping on a route.
+    Like haversine_vec but uses asin(x) ~ x, which is exact enough for neighbouring
+    polyline vertices and skips the arcsin per element. Pairs farther apart than
+    SMALL_ANGLE_MAX_M fall back to haversine_vec.
     """
     R = 6371000.0
-    x = math.radians(lon - lon0) * R * math.cos(math.radians(lat0))
-    y = math.radians(lat - lat0) * R
-    return x, y
+    lats1, lons1, lats2, lons2 = np.broadcast_arrays(
+        *(np.asarray(x, dtype=np.float64) for x in (lats1, lons1, lats2, lons2))
+    )
+    d = np.asarray(2 * R * np.sqrt(_haversine_h(lats1, lons1, lats2, lons2)))
+    far = d > SMALL_ANGLE_MAX_M
+    if np.any(far):
+        d[far] = haversine_vec(lats1[far], lons1[far], lats2[far], lons2[far])
+    return d
+
+def downsample_by_distance_np(
+    lat_arr: np.ndarray,
+    lon_arr: np.ndarray,
+    min_step_m: float = 15.0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Keep the first vertex at or past every multiple of min_step_m along the path
+    (prefix sums + binary search). Always keep first and last point.
+    Returns the kept (lat_arr, lon_arr).
+    """
+    n = len(lat_arr)
+    if n <= 1:
+        return np.array(lat_arr, dtype=np.float64), np.array(lon_arr, dtype=np.float64)
+    d = haversine_small_angle(lat_arr[:-1], lon_arr[:-1], lat_arr[1:], lon_arr[1:])
+    cum = np.concatenate(([0.0], np.cumsum(d)))
+    targets = np.arange(0.0, cum[-1], min_step_m)
+    idx = np.unique(np.concatenate(([0], np.searchsorted(cum, targets), [n - 1])))
+    return lat_arr[idx], lon_arr[idx]
 
 def _from_xy_m(lat0: float, lon0: float, x: float, y: float) -> Tuple[float, float]:
     R = 6371000.0
@@ -46,108 +70,174 @@ def _from_xy_m(lat0: float, lon0: float, x: float, y: float) -> Tuple[float, flo
     lon = lon0 + math.degrees(x / (R * math.cos(math.radians(lat0))))
     return lat, lon
 
-def build_cumdist_m(points_latlon: List[Tuple[float, float]]) -> List[float]:
-    """
-    cum[i] = meters from start to vertex i
-    """
-    if not points_latlon:
-        return []
-    cum = [0.0]
-    for i in range(1, len(points_latlon)):
-        cum.append(cum[-1] + haversine_m(points_latlon[i - 1], points_latlon[i]))
-    return cum
+# Route vertices are stored as int32 1e-7 degrees ("E7", ~1 cm): half the bytes of float64
+COORD_SCALE = 1e7
 
-def snap_point_to_polyline(
-    points_latlon: List[Tuple[float, float]],
-    cumdist_m: List[float],
-    gps_lat: float,
-    gps_lon: float
-) -> Dict[str, Any]:
+def build_route_arrays(points_latlon: List[Tuple[float, float]]) -> Dict[str, np.ndarray]:
     """
-    Project GPS point onto closest polyline segment.
-    Returns matched point + along-route meters + cross-track meters.
+    Contiguous arrays (SoA) for the snap kernel, computed once per route:
+    lat_i32, lon_i32 (int32, degrees * COORD_SCALE) and cum_arr (float64 meters from start) per vertex;
+    seg_len_m (haversine meters) per segment, with cum_arr[i+1] == cum_arr[i] + seg_len_m[i].
+    Segment directions are not stored: the kernel takes exact integer differences of
+    neighbouring E7 vertices.
     """
-    if len(points_latlon) < 2:
-        raise ValueError("Polyline needs at least 2 points")
-    if len(cumdist_m) != len(points_latlon):
-        raise ValueError("cumdist_m length mismatch")
-
-    lat0, lon0 = gps_lat, gps_lon
-    # GPS point is origin in local xy
-    px, py = 0.0, 0.0
-
-    best = {
-        "cross_track_m": float("inf"),
-        "segment_index": 0,
-        "t": 0.0,
-        "matched_lat": points_latlon[0][0],
-        "matched_lon": points_latlon[0][1],
-        "along_route_m": 0.0,
+    arr = np.asarray(points_latlon, dtype=np.float64).reshape(-1, 2)
+    lat_i32 = np.round(arr[:, 0] * COORD_SCALE).astype(np.int32)
+    lon_i32 = np.round(arr[:, 1] * COORD_SCALE).astype(np.int32)
+    # Lengths and prefix sums from the quantized vertices, so along_route_m is continuous
+    # across segment boundaries for the geometry the kernel actually sees
+    lat_arr = lat_i32 / COORD_SCALE
+    lon_arr = lon_i32 / COORD_SCALE
+    seg_len_m = haversine_small_angle(lat_arr[:-1], lon_arr[:-1], lat_arr[1:], lon_arr[1:])
+    return {
+        "lat_i32": lat_i32,
+        "lon_i32": lon_i32,
+        "cum_arr": np.concatenate(([0.0], np.cumsum(seg_len_m))),
+        "seg_len_m": seg_len_m,
     }
 
-    for i in range(len(points_latlon) - 1):
-        a_lat, a_lon = points_latlon[i]
-        b_lat, b_lon = points_latlon[i + 1]
-
-        ax, ay = _to_xy_m(lat0, lon0, a_lat, a_lon)
-        bx, by = _to_xy_m(lat0, lon0, b_lat, b_lon)
+def route_latlon(route: Dict[str, np.ndarray]) -> np.ndarray:
+    """
+    Route vertices from build_route_arrays() as a float64 array (N,2) of (lat, lon).
+    """
+    return np.column_stack((route["lat_i32"] / COORD_SCALE, route["lon_i32"] / COORD_SCALE))
 
-        vx, vy = (bx - ax), (by - ay)
-        wx, wy = (px - ax), (py - ay)
+@njit(cache=True, fastmath=True, nogil=True)
+def _snap_kernel(lat_i32, lon_i32, seg_len_m, cum_arr, gps_lat, gps_lon):
+    """
+    Closest-segment projection in local equirectangular meters around the GPS point.
+    Vertices are int32 E7 degrees and only widened to float64 here.
+    Returns (d, i, t, mx, my, along); i == -1 if every segment is degenerate.
+    """
+    R = 6371000.0
+    rad = math.pi / 180.0
+    # Scale factors are constant per fix: one cos() instead of one per vertex
+    R_cos = R * math.cos(gps_lat * rad)
+    kx = rad * R_cos
+    ky = rad * R
+    inv_scale = 1.0 / COORD_SCALE
+
+    best_d2 = 1e300
+    best_i = -1
+    best_t = 0.0
+    best_mx = 0.0
+    best_my = 0.0
+
+    for i in range(lat_i32.shape[0] - 1):
+        ax = (lon_i32[i] * inv_scale - gps_lon) * kx
+        ay = (lat_i32[i] * inv_scale - gps_lat) * ky
+        # Exact integer deltas of neighbouring E7 vertices; no per-segment float arrays to stream
+        vx = (lon_i32[i + 1] - lon_i32[i]) * inv_scale * kx
+        vy = (lat_i32[i + 1] - lat_i32[i]) * inv_scale * ky
 
         seg_len2 = vx * vx + vy * vy
         if seg_len2 <= 1e-9:
             continue
 
-        t = (wx * vx + wy * vy) / seg_len2
-        if t < 0.0:
-            t_clamped = 0.0
-        elif t > 1.0:
-            t_clamped = 1.0
-        else:
-            t_clamped = t
+        # min/max lower to minsd/maxsd; no data-dependent branch
+        t = max(0.0, min(1.0, (-ax * vx - ay * vy) / seg_len2))
 
-        mx = ax + t_clamped * vx
-        my = ay + t_clamped * vy
+        mx = ax + t * vx
+        my = ay + t * vy
+        # sqrt is monotonic: compare squared distances, take the root for the winner only
+        d2 = mx * mx + my * my
+        if d2 < best_d2:
+            best_d2 = d2
+            best_i = i
+            best_t = t
+            best_mx = mx
+            best_my = my
 
-        d = math.hypot(px - mx, py - my)
+    if best_i < 0:
+        return 0.0, -1, 0.0, 0.0, 0.0, 0.0
 
-        if d < best["cross_track_m"]:
-            mlat, mlon = _from_xy_m(lat0, lon0, mx, my)
+    along = cum_arr[best_i] + best_t * seg_len_m[best_i]
 
-            seg_len_m = haversine_m((a_lat, a_lon), (b_lat, b_lon))
-            along = cumdist_m[i] + t_clamped * seg_len_m
+    return math.sqrt(best_d2), best_i, best_t, best_mx, best_my, along
 
-            best = {
-                "cross_track_m": d,
-                "segment_index": i,
-                "t": t_clamped,
-                "matched_lat": mlat,
-                "matched_lon": mlon,
-                "along_route_m": along,
-            }
+def warmup_snap_kernel() -> None:
+    """
+    Trigger JIT compilation (or load from cache) so the first /match call is fast.
+    Warms both writable arrays (freshly prepared trips) and read-only ones
+    (bundles memory-mapped from the prepared cache), which Numba specializes separately.
+    """
+    route = build_route_arrays([(0.0, 0.0), (0.001, 0.0)])
+    snap_point_to_polyline(route, 0.0005, 0.0)
 
-    return best
+    readonly = {k: v.copy() for k, v in route.items()}
+    for v in readonly.values():
+        v.setflags(write=False)
+    snap_point_to_polyline(readonly, 0.0005, 0.0)
 
-def find_next_maneuver_index(maneuvers: List[dict], along_route_m: float, tolerance_m: float = 7.0) -> int:
+def snap_point_to_polyline(
+    route: Dict[str, np.ndarray],
+    gps_lat: float,
+    gps_lon: float,
+    start: int = 0,
+    end: Optional[int] = None
+) -> Dict[str, Any]:
     """
-    maneuvers must include 'along_route_m' (meters from route start).
-    Returns index of the next maneuver at/after current position (with small tolerance).
+    Project GPS point onto closest polyline segment.
+    route holds the arrays from build_route_arrays(); only vertices [start:end] are searched.
+    Returns matched point + along-route meters + cross-track meters.
     """
-    if not maneuvers:
-        return 0
-
-    candidates = []
-    for m in maneuvers:
-        am = m.get("along_route_m")
-        if am is None:
-            continue
-        if am >= (along_route_m - tolerance_m):
-            candidates.append((am, m["index"]))
+    lat_i32, lon_i32, cum_arr = route["lat_i32"], route["lon_i32"], route["cum_arr"]
+    if len(cum_arr) != len(lat_i32) or len(lon_i32) != len(lat_i32):
+        raise ValueError("cumdist_m length mismatch")
+    lat_w, lon_w, cum_w = lat_i32[start:end], lon_i32[start:end], cum_arr[start:end]
+    if len(lat_w) < 2:
+        raise ValueError("Polyline needs at least 2 points")
+    seg_end = start + len(lat_w) - 1
+
+    d, i, t, mx, my, along = _snap_kernel(
+        lat_w, lon_w,
+        route["seg_len_m"][start:seg_end],
+        cum_w, float(gps_lat), float(gps_lon)
+    )
+    if i < 0:
+        # Only degenerate segments
+        return {
+            "cross_track_m": float("inf"),
+            "segment_index": start,
+            "t": 0.0,
+            "matched_lat": float(lat_w[0]) / COORD_SCALE,
+            "matched_lon": float(lon_w[0]) / COORD_SCALE,
+            "along_route_m": float(cum_w[0]),
+        }
+
+    mlat, mlon = _from_xy_m(gps_lat, gps_lon, mx, my)
+    return {
+        "cross_track_m": d,
+        "segment_index": start + int(i),
+        "t": t + 0.0,  # normalise -0.0
+        "matched_lat": mlat,
+        "matched_lon": mlon,
+        "along_route_m": along,
+    }
 
-    if not candidates:
-        # Past all maneuvers -> last one
-        return maneuvers[-1]["index"]
+def build_maneuver_index(maneuvers: List[dict]) -> Dict[str, np.ndarray]:
+    """
+    maneuvers must include 'along_route_m' (meters from route start).
+    Returns maneuver_along (sorted, ascending) and the parallel maneuver_index array.
+    A trailing +inf sentinel maps "past all maneuvers" to the last maneuver.
+    """
+    pairs = [(m["along_route_m"], m["index"]) for m in maneuvers if m.get("along_route_m") is not None]
+    pairs.sort(key=lambda x: x[0])
+    fallback = maneuvers[-1]["index"] if maneuvers else 0
+    return {
+        "maneuver_along": np.array([p[0] for p in pairs] + [np.inf], dtype=np.float64),
+        "maneuver_index": np.array([p[1] for p in pairs] + [fallback], dtype=np.int64),
+    }
 
-    candidates.sort(key=lambda x: x[0])
-    return candidates[0][1]
+def find_next_maneuver_index(
+    maneuver_along: np.ndarray,
+    maneuver_index: np.ndarray,
+    along_route_m: float,
+    tolerance_m: float = 7.0
+) -> int:
+    """
+    Arrays come from build_maneuver_index().
+    Returns index of the next maneuver at/after current position (with small tolerance).
+    """
+    i = int(np.searchsorted(maneuver_along, along_route_m - tolerance_m, side="left"))
+    return int(maneuver_index[min(i, len(maneuver_index) - 1)])
@@ -1,39 +1,100 @@
-import csv
 import os
-from typing import Dict, List, Tuple
+import threading
+from typing import Callable, Dict, Iterable, Optional, Tuple
 
-def _read_csv(path: str) -> List[dict]:
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+
+# Process-level caches keyed by (path, mtime); a changed file is simply re-parsed
+_trip_to_shape_cache: Dict[Tuple[str, float], Dict[str, str]] = {}
+_shapes_cache: Dict[Tuple[str, float], Dict[str, np.ndarray]] = {}
+# One lock per cache: /prepare runs in FastAPI's threadpool, and a file must be parsed only once
+_trip_to_shape_lock = threading.Lock()
+_shapes_lock = threading.Lock()
+
+def _cache_key(path: str) -> Tuple[str, float]:
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Missing GTFS file: {path}")
+    return path, os.stat(path).st_mtime
+
+def _cached_load(cache: dict, lock: threading.Lock, path: str, build: Callable[[str], object]):
+    """
+    Returns cache[(path, mtime)], calling build(path) on a miss. Concurrent misses wait on the
+    lock and reuse the first thread's result instead of parsing the file again.
+    """
+    key = _cache_key(path)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    with lock:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+        value = build(path)
+        # Drop entries for older versions of the same file
+        for k in [k for k in cache if k[0] == path]:
+            cache.pop(k, None)
+        cache[key] = value
+        return value
+
+def _read_csv(path: str, columns: Iterable[str], dtype: Optional[Dict[str, pa.DataType]] = None) -> pd.DataFrame:
+    """
+    Reads only the wanted columns from a memory-mapped file (pages come from the shared OS cache).
+    Columns absent from the file come back as nulls; everything not listed in dtype is read as
+    string with empty cells kept as "".
+    """
     if not os.path.exists(path):
         raise FileNotFoundError(f"Missing GTFS file: {path}")
-    with open(path, "r", encoding="utf-8-sig", newline="") as f:
-        return list(csv.DictReader(f))
+    columns = list(columns)
+    dtype = dtype or {}
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=columns,
+        include_missing_columns=True,
+        column_types={c: dtype.get(c, pa.string()) for c in columns},
+    )
+    with pa.memory_map(path, "r") as source:
+        table = pa_csv.read_csv(source, convert_options=convert_options)
+    return table.to_pandas()
+
+def _parse_trip_to_shape_id(trips_path: str) -> Dict[str, str]:
+    df = _read_csv(trips_path, ["trip_id", "shape_id"])
+    df = df[df["trip_id"].notna() & df["shape_id"].notna()]
+    df = df[(df["trip_id"] != "") & (df["shape_id"] != "")]
+    return dict(zip(df["trip_id"], df["shape_id"]))
 
 def load_trip_to_shape_id(gtfs_dir: str) -> Dict[str, str]:
     trips_path = os.path.join(gtfs_dir, "trips.txt")
-    rows = _read_csv(trips_path)
-    out: Dict[str, str] = {}
-    for r in rows:
-        trip_id = r.get("trip_id")
-        shape_id = r.get("shape_id")
-        if trip_id and shape_id:
-            out[trip_id] = shape_id
+    return _cached_load(_trip_to_shape_cache, _trip_to_shape_lock, trips_path, _parse_trip_to_shape_id)
+
+def _parse_shapes(shapes_path: str) -> Dict[str, np.ndarray]:
+    df = _read_csv(
+        shapes_path,
+        ["shape_id", "shape_pt_lat", "shape_pt_lon", "shape_pt_sequence"],
+        dtype={"shape_pt_lat": pa.float64(), "shape_pt_lon": pa.float64(), "shape_pt_sequence": pa.int32()},
+    )
+    df = df.sort_values(["shape_id", "shape_pt_sequence"], kind="stable")
+    latlon = df[["shape_pt_lat", "shape_pt_lon"]].to_numpy(dtype=np.float64)
+
+    out: Dict[str, np.ndarray] = {}
+    for shape_id, idx in df.groupby("shape_id", sort=False).indices.items():
+        out[shape_id] = np.ascontiguousarray(latlon[idx])
     return out
 
-def load_shape_points(gtfs_dir: str, shape_id: str) -> List[Tuple[float, float, int]]:
+def load_all_shapes(gtfs_dir: str) -> Dict[str, np.ndarray]:
     """
-    Returns list of (lat, lon, seq) ordered by shape_pt_sequence.
+    Parses shapes.txt once into {shape_id: float64 array (N,2) of (lat, lon)},
+    each ordered by shape_pt_sequence.
     """
     shapes_path = os.path.join(gtfs_dir, "shapes.txt")
-    rows = _read_csv(shapes_path)
-
-    pts: List[Tuple[float, float, int]] = []
-    for r in rows:
-        if r.get("shape_id") != shape_id:
-            continue
-        lat = float(r["shape_pt_lat"])
-        lon = float(r["shape_pt_lon"])
-        seq = int(r["shape_pt_sequence"])
-        pts.append((lat, lon, seq))
-
-    pts.sort(key=lambda x: x[2])
-    return pts
+    return _cached_load(_shapes_cache, _shapes_lock, shapes_path, _parse_shapes)
+
+def load_shape_points(gtfs_dir: str, shape_id: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (lat_arr, lon_arr) float64 arrays ordered by shape_pt_sequence.
+    """
+    pts = load_all_shapes(gtfs_dir).get(shape_id)
+    if pts is None:
+        pts = np.empty((0, 2), dtype=np.float64)
+    return pts[:, 0], pts[:, 1]
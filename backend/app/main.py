@@ -1,22 +1,60 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import numpy as np
 from fastapi import FastAPI, HTTPException, Query
-from typing import Dict, Any, List, Tuple
+from fastapi.responses import ORJSONResponse
+from pydantic import TypeAdapter
+from typing import Dict, Any, List
 
 from .config import settings
 from .gtfs import load_trip_to_shape_id, load_shape_points
 from .geo import (
-    downsample_by_distance,
-    build_cumdist_m,
+    downsample_by_distance_np,
+    build_route_arrays,
+    build_maneuver_index,
+    route_latlon,
     snap_point_to_polyline,
+    warmup_snap_kernel,
     find_next_maneuver_index
 )
 from .valhalla import trace_route, parse_trace_route
+from .prepared_cache import (
+    gtfs_mtime,
+    normalize_min_step_m,
+    cache_namespace,
+    cache_key,
+    load_prepared,
+    save_prepared,
+    sweep_stale_tmp
+)
 from .models import RouteResult, LatLon, Maneuver, PrepareResult
 
-app = FastAPI(title="GTFS Shapes Navigation API", version="0.2.0")
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    # Compile (or load from cache) the snap kernel before the first /match,
+    # and clear temp dirs left by prepared-cache writers that crashed
+    warmup_snap_kernel()
+    sweep_stale_tmp(settings.prepared_cache_dir)
+    yield
+
+app = FastAPI(
+    title="GTFS Shapes Navigation API",
+    version="0.2.0",
+    default_response_class=ORJSONResponse,
+    lifespan=_lifespan,
+)
+
+# Batch validators: one call per list instead of one model construction per item
+_MANEUVER_LIST_VALIDATOR = TypeAdapter(List[Maneuver])
+_LATLON_LIST_VALIDATOR = TypeAdapter(List[LatLon])
 
 # In-memory cache (MVP). Later: Redis/db.
 ROUTE_CACHE: Dict[str, Dict[str, Any]] = {}
 
+# /match first searches this many meters around the last matched position
+SNAP_WINDOW_M = 200.0
+
 @app.get("/health")
 def health():
     return {"ok": True}
@@ -35,19 +73,34 @@ def _ensure_gtfs_files():
 
 def _prepare_trip_internal(trip_id: str, min_step_m: float, costing: str) -> Dict[str, Any]:
     _ensure_gtfs_files()
+    # Same value for the computation and the on-disk cache key
+    min_step_m = normalize_min_step_m(min_step_m)
 
     trip_to_shape = load_trip_to_shape_id(settings.gtfs_dir)
     shape_id = trip_to_shape.get(trip_id)
     if not shape_id:
         raise HTTPException(status_code=404, detail=f"trip_id not found or has no shape_id: {trip_id}")
 
-    pts = load_shape_points(settings.gtfs_dir, shape_id)
-    if len(pts) < 2:
+    # On-disk bundle from an earlier run (skips shape loading + Valhalla)
+    namespace = cache_namespace(gtfs_mtime(settings.gtfs_dir))
+    key = cache_key(trip_id, min_step_m, costing, settings.valhalla_url)
+    data = load_prepared(settings.prepared_cache_dir, namespace, key)
+    if data is not None and data["shape_id"] == shape_id:
+        data.update({
+            "trip_id": trip_id,
+            "last_along_m": None,
+            **build_maneuver_index(data["maneuvers"]),
+        })
+        ROUTE_CACHE[trip_id] = data
+        return data
+
+    lat_arr, lon_arr = load_shape_points(settings.gtfs_dir, shape_id)
+    if len(lat_arr) < 2:
         raise HTTPException(status_code=400, detail=f"shape_id has insufficient points: {shape_id}")
 
     # Downsample GTFS shape points for Valhalla request
-    pts_latlon: List[Tuple[float, float]] = [(p[0], p[1]) for p in pts]
-    pts_ds = downsample_by_distance(pts_latlon, min_step_m=min_step_m)
+    lat_ds, lon_ds = downsample_by_distance_np(lat_arr, lon_arr, min_step_m=min_step_m)
+    pts_ds = list(zip(lat_ds.tolist(), lon_ds.tolist()))
 
     try:
         trace = trace_route(settings.valhalla_url, pts_ds, costing=costing)
@@ -58,7 +111,8 @@ def _prepare_trip_internal(trip_id: str, min_step_m: float, costing: str) -> Dic
     if len(route_points) < 2:
         raise HTTPException(status_code=502, detail="Valhalla returned no usable route geometry")
 
-    route_cum = build_cumdist_m(route_points)
+    route = build_route_arrays(route_points)
+    route_cum = route["cum_arr"]
 
     # Fill along_route_m for maneuvers using begin_shape_index on Valhalla geometry (correct & safe)
     for m in maneuvers:
@@ -71,11 +125,13 @@ def _prepare_trip_internal(trip_id: str, min_step_m: float, costing: str) -> Dic
     data = {
         "trip_id": trip_id,
         "shape_id": shape_id,
-        "route_points": route_points,   # list[(lat, lon)]
-        "route_cum": route_cum,         # list[float] meters
+        **route,                        # lat/lon_i32, cum_arr, seg_len_m (np.ndarray)
         "maneuvers": maneuvers,         # list[dict]
+        **build_maneuver_index(maneuvers),  # maneuver_along / maneuver_index, sorted by along_route_m
         "total_distance_m": float(total_m),
+        "last_along_m": None,           # last matched along_route_m, narrows the next /match search
     }
+    save_prepared(settings.prepared_cache_dir, namespace, key, data)
     ROUTE_CACHE[trip_id] = data
     return data
 
@@ -89,7 +145,7 @@ def prepare_trip(
     return PrepareResult(
         trip_id=trip_id,
         shape_id=data["shape_id"],
-        route_points_count=len(data["route_points"]),
+        route_points_count=len(data["lat_i32"]),
         maneuvers_count=len(data["maneuvers"]),
         total_distance_m=data["total_distance_m"]
     )
@@ -102,12 +158,31 @@ def route_geometry(trip_id: str):
     return {
         "trip_id": trip_id,
         "shape_id": data["shape_id"],
-        "route_geometry": [{"lat": lat, "lon": lon} for (lat, lon) in data["route_points"]],
+        "route_geometry": [{"lat": lat, "lon": lon} for (lat, lon) in route_latlon(data).tolist()],
         "total_distance_m": data["total_distance_m"]
     }
 
+def _snap_near_last(data: Dict[str, Any], lat: float, lon: float, offroute_threshold_m: float) -> Dict[str, Any]:
+    cum_arr = data["cum_arr"]
+
+    snap = None
+    last = data.get("last_along_m")
+    if last is not None:
+        lo = int(np.searchsorted(cum_arr, last - SNAP_WINDOW_M, side="left"))
+        hi = int(np.searchsorted(cum_arr, last + SNAP_WINDOW_M, side="right"))
+        # Include the segments entering and leaving the window
+        start, end = max(lo - 1, 0), min(hi + 1, len(cum_arr))
+        if end - start >= 2:
+            snap = snap_point_to_polyline(data, lat, lon, start=start, end=end)
+            if snap["cross_track_m"] > offroute_threshold_m:
+                snap = None
+    if snap is None:
+        # First fix or looks off-route within the window: full scan
+        snap = snap_point_to_polyline(data, lat, lon)
+    return snap
+
 @app.get("/api/trips/{trip_id}/match")
-def match_position(
+async def match_position(
     trip_id: str,
     lat: float = Query(...),
     lon: float = Query(...),
@@ -117,16 +192,19 @@ def match_position(
     if not data:
         raise HTTPException(status_code=400, detail="Trip not prepared. Call /prepare first.")
 
-    route_points = data["route_points"]
-    route_cum = data["route_cum"]
     maneuvers = data["maneuvers"]
 
-    snap = snap_point_to_polyline(route_points, route_cum, lat, lon)
+    # The snap kernel releases the GIL, so concurrent fixes overlap in worker threads
+    snap = await asyncio.to_thread(_snap_near_last, data, lat, lon, offroute_threshold_m)
     along = float(snap["along_route_m"])
     cross = float(snap["cross_track_m"])
+    data["last_along_m"] = along
 
-    next_idx = find_next_maneuver_index(maneuvers, along_route_m=along, tolerance_m=7.0)
-    next_man = next((m for m in maneuvers if m["index"] == next_idx), None)
+    next_idx = find_next_maneuver_index(
+        data["maneuver_along"], data["maneuver_index"], along_route_m=along, tolerance_m=7.0
+    )
+    # parse_trace_route numbers maneuvers by position
+    next_man = maneuvers[next_idx] if 0 <= next_idx < len(maneuvers) else None
 
     if next_man and next_man.get("along_route_m") is not None:
         dist_to_next = float(next_man["along_route_m"]) - along
@@ -167,8 +245,10 @@ def route_full(
     """
     data = _prepare_trip_internal(trip_id, min_step_m=min_step_m, costing=costing)
 
-    maneuvers = [Maneuver(**m) for m in data["maneuvers"]]
-    route_geometry = [LatLon(lat=lat, lon=lon) for (lat, lon) in data["route_points"]]
+    maneuvers = _MANEUVER_LIST_VALIDATOR.validate_python(data["maneuvers"])
+    route_geometry = _LATLON_LIST_VALIDATOR.validate_python(
+        [{"lat": lat, "lon": lon} for (lat, lon) in route_latlon(data).tolist()]
+    )
 
     return RouteResult(
         trip_id=trip_id,
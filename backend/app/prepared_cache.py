@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+# Bump whenever the meaning of stored data changes (decoding, units, ...); old entries are then ignored
+# 2: Valhalla shapes decoded at precision 6 (earlier bundles were decoded at precision 5)
+# 3: vertices as int32 E7, no per-segment direction arrays
+# 4: cum_arr derived from the quantized seg_len_m
+CACHE_VERSION = 4
+
+# Arrays from geo.build_route_arrays(); each is stored as its own .npy so it can be mmapped
+ARRAY_KEYS = ("lat_i32", "lon_i32", "cum_arr", "seg_len_m")
+
+# Layout: <cache_dir>/<namespace>/<key>/, namespace = CACHE_VERSION + GTFS mtime.
+# Writing into a new namespace deletes the others, so the cache holds one feed version at a time.
+_NAMESPACE_RE = re.compile(r"^v\d+-[0-9.]+$")
+_LEGACY_KEY_RE = re.compile(r"^[0-9a-f]{40}$")  # bundles written before namespaces existed
+
+# Temp dirs older than this are leftovers of a crashed writer
+_STALE_TMP_S = 3600.0
+
+def gtfs_mtime(gtfs_dir: str) -> float:
+    return max(os.stat(os.path.join(gtfs_dir, f)).st_mtime for f in ("trips.txt", "shapes.txt"))
+
+def normalize_min_step_m(min_step_m: float) -> float:
+    # Whole meters: nearby query values share one bundle (and one Valhalla call)
+    return float(round(min_step_m))
+
+def cache_namespace(gtfs_mtime: float) -> str:
+    return f"v{CACHE_VERSION}-{gtfs_mtime:.6f}"
+
+def cache_key(trip_id: str, min_step_m: float, costing: str, valhalla_url: str) -> str:
+    # Stored arrays are part of the key, so a layout change never hits old entries
+    raw = json.dumps([ARRAY_KEYS, trip_id, min_step_m, costing, valhalla_url])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def sweep_stale_tmp(cache_dir: str) -> None:
+    """
+    Removes .tmp-* dirs left by writers that died mid-save (top level and inside namespaces).
+    Recent ones are kept: another worker may still be writing them.
+    """
+    cutoff = time.time() - _STALE_TMP_S
+    try:
+        dirs = [cache_dir] + [
+            os.path.join(cache_dir, n) for n in os.listdir(cache_dir) if _NAMESPACE_RE.match(n)
+        ]
+    except OSError:
+        return
+    for d in dirs:
+        try:
+            names = os.listdir(d)
+        except OSError:
+            continue
+        for n in names:
+            p = os.path.join(d, n)
+            try:
+                if n.startswith(".tmp-") and os.stat(p).st_mtime < cutoff:
+                    shutil.rmtree(p, ignore_errors=True)
+            except OSError:
+                pass
+
+def _drop_other_namespaces(cache_dir: str, namespace: str) -> None:
+    for n in os.listdir(cache_dir):
+        if n != namespace and (_NAMESPACE_RE.match(n) or _LEGACY_KEY_RE.match(n)):
+            shutil.rmtree(os.path.join(cache_dir, n), ignore_errors=True)
+
+def load_prepared(cache_dir: str, namespace: str, key: str) -> Optional[Dict[str, Any]]:
+    """
+    Returns the stored bundle, or None on a miss or unreadable entry.
+    Arrays are read-only memory maps over the .npy files (shared page cache across workers).
+    """
+    path = os.path.join(cache_dir, namespace, key)
+    try:
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for k in ARRAY_KEYS:
+            data[k] = np.load(os.path.join(path, f"{k}.npy"), mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    return data
+
+def save_prepared(cache_dir: str, namespace: str, key: str, data: Dict[str, Any]) -> None:
+    """
+    Writes shape_id / maneuvers / total_distance_m as JSON plus one .npy per array.
+    An existing entry under the same key (one load_prepared rejected) is replaced;
+    the first write into a namespace removes all other namespaces.
+    Best effort: a failed write only costs a recompute next time.
+    """
+    meta = {
+        "shape_id": data["shape_id"],
+        "maneuvers": data["maneuvers"],
+        "total_distance_m": data["total_distance_m"],
+    }
+    try:
+        ns_dir = os.path.join(cache_dir, namespace)
+        if not os.path.isdir(ns_dir):
+            os.makedirs(ns_dir, exist_ok=True)
+            _drop_other_namespaces(cache_dir, namespace)
+        tmp = tempfile.mkdtemp(dir=ns_dir, prefix=".tmp-")
+        try:
+            with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            for k in ARRAY_KEYS:
+                np.save(os.path.join(tmp, f"{k}.npy"), np.ascontiguousarray(data[k]))
+            target = os.path.join(ns_dir, key)
+            try:
+                # Atomic publish
+                os.rename(tmp, target)
+            except OSError:
+                # Unreadable / stale entry (or another worker's equal one): replace it
+                shutil.rmtree(target, ignore_errors=True)
+                os.rename(tmp, target)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+    except OSError:
+        pass
@@ -1,13 +1,22 @@
+import re
 from typing import List, Tuple, Dict, Any
+import numpy as np
+import orjson
 import requests
-import polyline
+from numba import njit
+from requests.adapters import HTTPAdapter
+
+# Shared keep-alive connection pool; /prepare calls run concurrently in FastAPI's threadpool
+_VALHALLA = requests.Session()
+_VALHALLA.mount("http://", HTTPAdapter(pool_maxsize=32))
+_VALHALLA.mount("https://", HTTPAdapter(pool_maxsize=32))
 
 def trace_route(valhalla_url: str, points: List[Tuple[float, float]], costing: str = "auto") -> Dict[str, Any]:
     """
     Calls Valhalla /trace_route with shape points.
     points: list of (lat, lon)
     """
-    shape = [{"lat": lat, "lon": lon} for lat, lon in points]
+    shape = [{"lat": float(lat), "lon": float(lon)} for lat, lon in points]
     payload = {
         "shape": shape,
         "costing": costing,
@@ -16,42 +25,88 @@ def trace_route(valhalla_url: str, points: List[Tuple[float, float]], costing: s
         "directions_options": {"units": "kilometers"}
     }
     url = valhalla_url.rstrip("/") + "/trace_route"
-    r = requests.post(url, json=payload, timeout=30)
+    r = _VALHALLA.post(
+        url,
+        data=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"},
+        timeout=30,
+    )
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
+
+@njit(cache=True)
+def _decode_polyline_kernel(buf, factor):
+    # Google encoded polyline: zigzag varints, 5 bits per char offset by 63, (lat, lon) deltas
+    n = buf.shape[0]
+    out = np.empty((n // 2 + 1, 2), dtype=np.float64)
+    i = 0
+    k = 0
+    lat = 0
+    lon = 0
+    while i < n:
+        for c in range(2):
+            result = 0
+            shift = 0
+            while i < n:
+                b = np.int64(buf[i]) - 63
+                i += 1
+                result |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            delta = ~(result >> 1) if (result & 1) else (result >> 1)
+            if c == 0:
+                lat += delta
+            else:
+                lon += delta
+        out[k, 0] = lat / factor
+        out[k, 1] = lon / factor
+        k += 1
+    return out[:k].copy()
+
+def decode_polyline6(enc: str) -> np.ndarray:
+    """
+    Decodes a Valhalla shape string (precision 6) into a float64 array (N,2) of (lat, lon).
+    """
+    buf = np.frombuffer(enc.encode("ascii"), dtype=np.uint8)
+    return _decode_polyline_kernel(buf, 1e6)
+
+# Instruction keywords (English + Dutch) per maneuver type, in priority order
+_KEYWORDS = [
+    ("roundabout", ["roundabout", "rotonde"]),
+    ("arrive", ["arrive", "bestemming"]),
+    ("uturn", ["u-turn", "keer om"]),
+    ("left", ["left", "links"]),
+    ("right", ["right", "rechts"]),
+    ("merge", ["merge", "voeg"]),
+    ("exit", ["exit", "afrit"]),
+    ("start", ["start"]),
+    ("straight", ["straight", "rechtdoor"]),
+]
+_KEYWORD_RE = re.compile("|".join(
+    f"(?P<{t}>{'|'.join(re.escape(k) for k in kws)})" for t, kws in _KEYWORDS
+))
+_KEYWORD_RANK = {t: rank for rank, (t, _) in enumerate(_KEYWORDS)}
 
 def _map_valhalla_type(m: Dict[str, Any]) -> str:
     """
     We map by instruction keywords to keep it stable across Valhalla versions.
     You will later ignore instruction and use your own NL texts for UI/audio.
+    One regex pass finds every keyword; the highest-priority type wins.
     """
     instr = (m.get("instruction") or "").lower()
 
-    if "roundabout" in instr or "rotonde" in instr:
-        return "roundabout"
-    if "arrive" in instr or "bestemming" in instr:
-        return "arrive"
-    if "u-turn" in instr or "keer om" in instr:
-        return "uturn"
-    if "left" in instr or "links" in instr:
-        return "left"
-    if "right" in instr or "rechts" in instr:
-        return "right"
-    if "merge" in instr or "voeg" in instr:
-        return "merge"
-    if "exit" in instr or "afrit" in instr:
-        return "exit"
-    if "start" in instr:
-        return "start"
-    if "straight" in instr or "rechtdoor" in instr:
-        return "straight"
-    return "unknown"
+    found = {match.lastgroup for match in _KEYWORD_RE.finditer(instr)}
+    if not found:
+        return "unknown"
+    return min(found, key=_KEYWORD_RANK.__getitem__)
 
-def parse_trace_route(trace_json: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], float, List[Tuple[float, float]]]:
+def parse_trace_route(trace_json: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], float, np.ndarray]:
     """
     Returns (maneuvers, total_distance_m, route_points)
 
-    route_points is Valhalla's matched route geometry decoded from legs[].shape.
+    route_points is Valhalla's matched route geometry decoded from legs[].shape,
+    as a float64 array (N,2) of (lat, lon).
     Maneuver begin_shape_index refers to that route geometry -> consistent and safe.
     """
     trip = trace_json.get("trip", {})
@@ -61,11 +116,8 @@ def parse_trace_route(trace_json: Dict[str, Any]) -> Tuple[List[Dict[str, Any]],
     total_km = 0.0
 
     # Matched geometry
-    route_points: List[Tuple[float, float]] = []
-    for leg in legs:
-        enc = leg.get("shape")
-        if enc:
-            route_points.extend(polyline.decode(enc))
+    parts = [decode_polyline6(leg["shape"]) for leg in legs if leg.get("shape")]
+    route_points = np.concatenate(parts) if parts else np.empty((0, 2), dtype=np.float64)
 
     idx = 0
     for leg in legs: